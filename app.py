@@ -1,207 +1,590 @@
 import os
-from typing import Dict, List, Tuple, Any, TypedDict, Optional
+import time
+import uuid
+import asyncio
+import threading
+from functools import partial, lru_cache
+from typing import Dict, List, Tuple, Any, TypedDict, NamedTuple, Optional, Type, TypeVar, Callable, Awaitable
+import re
 import json
+import hashlib
+import unicodedata
 from pathlib import Path
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 from dotenv import load_dotenv
+from pydantic import BaseModel, ValidationError
+from jinja2 import Environment, DictLoader
 
 # Bibliotecas para LangGraph
 from langgraph.graph import StateGraph, END
 from langgraph.checkpoint.memory import MemorySaver
-import langchain
 
 # Bibliotecas para Gemini/Vertex AI
-from google.cloud import aiplatform
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import GenerativeModel, GenerationConfig
 import vertexai
 
-# Biblioteca para exportação
-from docx import Document
+from google.api_core.exceptions import DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable
+from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+# Cache de respostas do modelo
+from diskcache import Cache
 
 load_dotenv()
 
-# Configuração de logs
+# Configuração de logs: os handlers de arquivo e console rodam na thread do QueueListener,
+# para que a formatação e a escrita dos logs não bloqueiem o event loop
+log_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+log_handlers = [
+    logging.FileHandler("book_generation.log"),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("book_generation.log"),
-        logging.StreamHandler()
-    ]
+    format="%(message)s",
+    handlers=[QueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
+# Número máximo de capítulos escritos simultaneamente (ajuste conforme a cota do Vertex AI)
+MAX_CONCURRENT_CHAPTERS = int(os.getenv("MAX_CONCURRENT_CHAPTERS", "5"))
+
+MODEL_NAME = "gemini-2.0-flash-001"
+# Modelo mais barato e rápido para tarefas auxiliares, como os resumos dos capítulos
+SUMMARY_MODEL_NAME = "gemini-2.0-flash-lite-001"
+
+# Cache das respostas do modelo (chave: modelo + prompt + parâmetros), em disco ou no Redis.
+# Com LLM_CACHE=0 (ou --no-cache) todas as respostas são geradas novamente
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 60 * 60)))
+REDIS_URL = os.getenv("REDIS_URL")
+cache_stats = {"hits": 0, "semantic_hits": 0, "misses": 0}
+
+# Cache semântico opcional (requer sqlite-vec e sentence-transformers)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+class NamedModel(NamedTuple):
+    """Modelo do Vertex AI junto com o seu nome, que faz parte da chave do cache."""
+    name: str
+    model: GenerativeModel
+
 # Inicializar Vertex AI
-def init_vertex_ai(project_id: str, location: str = "us-central1"):
-    """Inicializa a conexão com o Vertex AI."""
-    logger.info("Inicializando Vertex AI...")
-    vertexai.init(project=os.getenv("PROJECT_ID"), location=os.getenv("LOCATION"))
-    return GenerativeModel("gemini-2.0-flash-001")
+# vertexai.init configura o SDK globalmente e só precisa ser chamado uma vez por processo
+_vertex_initialized = False
 
-# Função auxiliar para parsing seguro de JSON
-def safe_json_parse(response_text: str, fallback: Any) -> Any:
-    """Tenta decodificar JSON e retorna um fallback em caso de erro."""
-    # Remove code block markers if present
-    if response_text.startswith("```json"):
-        response_text = response_text[7:]
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
-    elif response_text.startswith("```"):
-        response_text = response_text[3:]
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
+async def init_vertex_ai(project_id: str, location: str = "us-central1"):
+    """Inicializa o Vertex AI, aquece os clientes e retorna o modelo principal e o de resumos."""
+    global _vertex_initialized
+    if not _vertex_initialized:
+        logger.info("Inicializando Vertex AI...")
+        vertexai.init(project=os.getenv("PROJECT_ID"), location=os.getenv("LOCATION"))
+        _vertex_initialized = True
+    # Os clientes assíncronos ficam presos ao event loop atual, então os modelos são criados a cada execução
+    model = NamedModel(MODEL_NAME, GenerativeModel(MODEL_NAME))
+    summary_model = NamedModel(SUMMARY_MODEL_NAME, GenerativeModel(SUMMARY_MODEL_NAME))
+    # A primeira chamada lê as credenciais e abre o canal; fazê-la aqui tira esse custo dos nós do grafo
+    warmup_config = GenerationConfig(max_output_tokens=1)
+    await asyncio.gather(model.model.generate_content_async("ping", generation_config=warmup_config),
+                         summary_model.model.generate_content_async("ping", generation_config=warmup_config))
+    return model, summary_model
+
+class RedisCache:
+    """Cache de respostas no Redis, com a mesma interface `get`/`set` do diskcache."""
+    
+    def __init__(self, url: str):
+        import redis
+        
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.error = redis.RedisError
+    
+    # Uma falha do Redis não deve interromper a geração: vira uma falha de cache
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return self.client.get(key)
+        except self.error as e:
+            logger.warning(f"Erro ao consultar o Redis ({e}). Tratando como falha de cache.")
+            return None
+    
+    def set(self, key: str, value: str, expire: Optional[int] = None):
+        try:
+            self.client.set(key, value, ex=expire)
+        except self.error as e:
+            logger.warning(f"Erro ao gravar no Redis ({e}). Resposta não armazenada.")
+
+@lru_cache(maxsize=None)
+def get_llm_cache():
+    """Cria o cache de respostas sob demanda: no Redis, se REDIS_URL estiver definido, ou em disco."""
+    return RedisCache(REDIS_URL) if REDIS_URL else Cache(LLM_CACHE_DIR)
+
+class SemanticCache:
+    """Reutiliza respostas de prompts semanticamente equivalentes via busca vetorial no SQLite."""
+    
+    def __init__(self, path: str, ttl: int, threshold: float):
+        import sqlite3
+        import sqlite_vec
+        from sentence_transformers import SentenceTransformer
+        
+        self.ttl = ttl
+        self.threshold = threshold
+        # A conexão é compartilhada entre as threads que consultam o cache
+        self.lock = threading.Lock()
+        self.encoder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        dimensions = self.encoder.get_sentence_embedding_dimension()
+        
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.enable_load_extension(True)
+        sqlite_vec.load(self.db)
+        self.db.enable_load_extension(False)
+        self.db.executescript(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS prompt_embeddings USING vec0(
+                namespace TEXT PARTITION KEY,
+                embedding FLOAT[{dimensions}] distance_metric=cosine
+            );
+            CREATE TABLE IF NOT EXISTS prompt_responses (
+                id INTEGER PRIMARY KEY,
+                prompt TEXT NOT NULL,
+                response TEXT NOT NULL,
+                ts REAL NOT NULL
+            );
+        """)
+    
+    def embed(self, text: str) -> bytes:
+        """Calcula o embedding normalizado do texto no formato aceito pelo sqlite-vec."""
+        return self.encoder.encode(text, normalize_embeddings=True).astype("float32").tobytes()
+    
+    def _purge_expired(self):
+        """Remove as respostas (e seus embeddings) mais antigas que o TTL."""
+        cutoff = time.time() - self.ttl
+        with self.db:
+            self.db.execute("DELETE FROM prompt_embeddings WHERE rowid IN "
+                            "(SELECT id FROM prompt_responses WHERE ts < ?)", (cutoff,))
+            self.db.execute("DELETE FROM prompt_responses WHERE ts < ?", (cutoff,))
+    
+    def lookup(self, embedding: bytes, namespace: str) -> Optional[str]:
+        """Retorna a resposta do texto mais próximo se a similaridade superar o limiar."""
+        with self.lock:
+            # Sem a limpeza, uma entrada expirada continuaria sendo o vizinho mais próximo
+            self._purge_expired()
+            row = self.db.execute("""
+                WITH knn AS (
+                    SELECT rowid, distance FROM prompt_embeddings
+                    WHERE embedding MATCH ? AND k = 1 AND namespace = ?
+                )
+                SELECT r.response, knn.distance FROM knn JOIN prompt_responses r ON r.id = knn.rowid
+            """, (embedding, namespace)).fetchone()
+        if row is None:
+            return None
+        response, distance = row
+        if 1 - distance < self.threshold:
+            return None
+        return response
+    
+    def store(self, embedding: bytes, namespace: str, text: str, response: str):
+        """Armazena a resposta gerada para o texto."""
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO prompt_responses (prompt, response, ts) VALUES (?, ?, ?)",
+                (text, response, time.time())
+            )
+            self.db.execute(
+                "INSERT INTO prompt_embeddings (rowid, namespace, embedding) VALUES (?, ?, ?)",
+                (cursor.lastrowid, namespace, embedding)
+            )
+
+@lru_cache(maxsize=None)
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """Cria o cache semântico sob demanda, se habilitado e com as dependências instaladas."""
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    import sqlite3
     
     try:
-        return json.loads(response_text)
-    except json.JSONDecodeError:
-        logger.error(f"Erro ao decodificar JSON: {response_text[:100]}... Usando fallback.")
-        return fallback
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        return SemanticCache(os.path.join(LLM_CACHE_DIR, "semantic.sqlite3"),
+                             LLM_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD)
+    except ImportError as e:
+        logger.warning(f"Cache semântico desabilitado: dependência ausente ({e}).")
+        return None
+    except (AttributeError, OSError, sqlite3.Error) as e:
+        # Python sem suporte a extensões do SQLite, falha ao baixar o modelo de embeddings etc.
+        logger.warning(f"Cache semântico desabilitado: falha ao inicializar ({e}).")
+        return None
+
+def _cache_key(model_name: str, prompt: str, response_schema: Optional[Dict[str, Any]]) -> str:
+    """Calcula a chave do cache para uma chamada ao modelo."""
+    payload = json.dumps({"m": model_name, "p": prompt, "s": response_schema}, sort_keys=True)
+    return "gemini:" + hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+def _cache_lookup(model_name: str, prompt: str, response_schema: Optional[Dict[str, Any]],
+                  semantic: Optional[Tuple[str, str]]) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Procura a resposta no cache exato e no semântico; retorna (resposta ou None, contexto).
+    
+    `semantic` é o par (namespace, texto): o texto deve ser só a parte variável do prompt.
+    """
+    context = {"key": _cache_key(model_name, prompt, response_schema)}
+    if not LLM_CACHE_ENABLED:
+        return None, context
+    cached = get_llm_cache().get(context["key"])
+    if cached is not None:
+        cache_stats["hits"] += 1
+        logger.debug(f"Resposta encontrada no cache: {context['key']}")
+        return cached, context
+    
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None and semantic is not None:
+        namespace, context["semantic_text"] = semantic
+        context["namespace"] = f"{model_name}|{namespace}"
+        context["embedding"] = semantic_cache.embed(context["semantic_text"])
+        cached = semantic_cache.lookup(context["embedding"], context["namespace"])
+        if cached is not None:
+            cache_stats["semantic_hits"] += 1
+            logger.debug(f"Resposta encontrada no cache semântico: {context['key']}")
+            get_llm_cache().set(context["key"], cached, expire=LLM_CACHE_TTL)
+            return cached, context
+    
+    cache_stats["misses"] += 1
+    return None, context
+
+def _cache_store(context: Dict[str, Any], response_text: str):
+    """Armazena uma resposta recém-gerada nos caches."""
+    if not LLM_CACHE_ENABLED:
+        return
+    get_llm_cache().set(context["key"], response_text, expire=LLM_CACHE_TTL)
+    if "embedding" in context:
+        get_semantic_cache().store(context["embedding"], context["namespace"], context["semantic_text"], response_text)
+
+# Erros transitórios da API (cota, indisponibilidade, timeout), que valem uma nova tentativa
+TRANSIENT_API_ERRORS = (ResourceExhausted, ServiceUnavailable, DeadlineExceeded, InternalServerError)
+
+@retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(3),
+       retry=retry_if_exception_type(TRANSIENT_API_ERRORS), reraise=True,
+       before_sleep=before_sleep_log(logger, logging.WARNING))
+async def _request(model, prompt: str, generation_config: GenerationConfig, stream: bool = False):
+    """Envia a requisição ao modelo, repetindo com backoff exponencial e jitter em erros transitórios.
+    
+    Em streaming, só a abertura da requisição é repetida.
+    """
+    return await model.generate_content_async(prompt, generation_config=generation_config, stream=stream)
+
+async def _generate(model, prompt: str, response_schema: Optional[Dict[str, Any]] = None,
+                    on_chunk: Optional[Callable[[str], Awaitable[Any]]] = None) -> str:
+    """Gera conteúdo com o modelo, sem cache (com `on_chunk`, em streaming)."""
+    json_options = {"response_mime_type": "application/json", "response_schema": response_schema} if response_schema else {}
+    generation_config = GenerationConfig(**json_options)
+    if on_chunk:
+        parts = []
+        stream = await _request(model, prompt, generation_config, stream=True)
+        async for chunk in stream:
+            parts.append(chunk.text)
+            await on_chunk(chunk.text)
+        text = "".join(parts)
+    else:
+        response = await _request(model, prompt, generation_config)
+        text = response.text
+    return text
+
+async def cached_generate(model: NamedModel, prompt: str,
+                          on_chunk: Optional[Callable[[str], Awaitable[Any]]] = None) -> str:
+    """Gera conteúdo com o modelo (ver `_generate`), reutilizando respostas em cache.
+    
+    Em um acerto de cache, `on_chunk` recebe o texto completo de uma vez.
+    """
+    # As consultas ao cache fazem I/O em disco, então rodam fora do event loop
+    cached, context = await asyncio.to_thread(_cache_lookup, model.name, prompt, None, None)
+    if cached is not None:
+        if on_chunk:
+            await on_chunk(cached)
+        return cached
+    text = await _generate(model.model, prompt, on_chunk=on_chunk)
+    await asyncio.to_thread(_cache_store, context, text)
+    return text
+
+# Esquemas das respostas estruturadas do modelo
+class OutlineItem(BaseModel):
+    chapter_number: int
+    chapter_title: str
+    chapter_description: str
+
+class BookPlan(BaseModel):
+    title: str
+    outline: List[OutlineItem]
+
+class ChapterModel(BaseModel):
+    """Capítulo no estado do grafo. O texto fica no rascunho em disco, não aqui."""
+    number: int
+    title: str
+    description: str
+    summary: str = ""  # preenchido após a escrita
+
+SchemaT = TypeVar("SchemaT", bound=BaseModel)
+
+# Esquema de `BookPlan` no formato aceito pelo Vertex AI (subconjunto do OpenAPI, sem $ref)
+BOOK_PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string", "description": "Título formal e técnico do livro"},
+        "outline": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "chapter_number": {"type": "integer"},
+                    "chapter_title": {"type": "string"},
+                    "chapter_description": {"type": "string"}
+                },
+                "required": ["chapter_number", "chapter_title", "chapter_description"]
+            }
+        }
+    },
+    "required": ["title", "outline"]
+}
+
+# Função auxiliar para parsing seguro de JSON
+def parse_json(response_text: str, schema: Type[SchemaT]) -> SchemaT:
+    """Decodifica e valida o JSON contra `schema`, levantando `ValidationError` em caso de erro."""
+    # Recorta do primeiro "{" (ou "[") até o fechamento correspondente mais à direita,
+    # descartando blocos de código (```json) e qualquer texto ao redor do JSON
+    data = response_text.encode()
+    candidates = []
+    for opener, closer in ((b"{", b"}"), (b"[", b"]")):
+        start, end = data.find(opener), data.rfind(closer) + 1
+        if start != -1 and end > start:
+            candidates.append((start, data[start:end]))
+    # Tenta primeiro o recorte que começa antes; se falhar (ex.: "[nota] {...}"), tenta o outro
+    candidates = [candidate for _, candidate in sorted(candidates)] or [data]
+    
+    error = None
+    for candidate in candidates:
+        try:
+            # Parsing (jiter) e validação do esquema em uma única passagem
+            return schema.model_validate_json(candidate)
+        except ValidationError as e:
+            error = error or e
+    raise error
+
+async def generate_validated(model: NamedModel, prompt: str, fallback: SchemaT, schema: Type[SchemaT],
+                             response_schema: Dict[str, Any], semantic: Optional[Tuple[str, str]] = None,
+                             retries: int = 2) -> SchemaT:
+    """Gera uma resposta estruturada, devolvendo os erros de validação ao modelo até `retries` vezes.
+    
+    Só respostas válidas vão para o cache; esgotadas as tentativas, retorna o fallback.
+    """
+    cached, context = await asyncio.to_thread(_cache_lookup, model.name, prompt, response_schema, semantic)
+    if cached is not None:
+        try:
+            return parse_json(cached, schema)
+        except ValidationError as e:
+            logger.warning(f"Resposta inválida no cache ({e}). Gerando novamente.")
+    
+    attempt_prompt = prompt
+    for attempt in range(retries + 1):
+        # As tentativas de correção não consultam o cache, que só guarda respostas válidas
+        response_text = await _generate(model.model, attempt_prompt, response_schema=response_schema)
+        logger.debug(f"Resposta bruta do modelo: {response_text}")
+        try:
+            parsed = parse_json(response_text, schema)
+        except ValidationError as e:
+            logger.warning(f"Resposta inválida na tentativa {attempt + 1} de {retries + 1} ({e}): {response_text[:100]}...")
+            attempt_prompt = (f"{prompt}\n\nSua resposta anterior falhou na validação: {e}. "
+                              "Responda novamente, corrigindo esses erros.")
+            continue
+        await asyncio.to_thread(_cache_store, context, response_text)
+        return parsed
+    logger.error(f"Nenhuma resposta válida após {retries + 1} tentativas. Usando fallback.")
+    return fallback
 
 # Definição dos estados do grafo
 class BookState(TypedDict, total=False):
     theme: str
     title: str
+    slug: str
     genre: str
     target_audience: str
-    outline: List[Dict[str, Any]]
-    chapters: Dict[int, Dict[str, str]]
-    current_chapter: int
+    chapters: List[ChapterModel]  # em ordem de leitura
+    drafts_dir: str
     status: str
     feedback: str
     export_path: str
     feedback_path: str
 
-# Funções para cada etapa do processo
-def get_book_info(state: BookState, model) -> Dict[str, Any]:
-    """Obtém informações básicas e gera o título com base no tema."""
-    logger.info(f"Estado recebido em get_book_info: {state}")
-    logger.info("Coletando informações básicas do livro...")
-    updates = {}
+# Modelos de prompt, compilados uma única vez no carregamento do módulo.
+# No prompt dos capítulos, o preâmbulo do livro vem antes e as variáveis do capítulo ficam
+# no final, para que todas as chamadas de um mesmo livro compartilhem o mesmo prefixo.
+PROMPT_TEMPLATES = {
+    "plan_book": """
+    Você é um especialista técnico elaborando um livro técnico para estudo de um determinado tema. 
+    Baseado nas seguintes informações, sugira um título formal e técnico que reflita um enfoque analítico e informativo
+    e crie um sumário detalhado e com pelo menos 3 níveis de aprofundamento com foco em aspectos técnicos e práticos:
     
-    # Garantir valores padrão se não fornecidos
-    theme = state.get("theme", "Um tema genérico")
-    genre = state.get("genre", "Ficção")
-    target_audience = state.get("target_audience", "Adultos")
+    Tema: {{ theme }}
+    Gênero: {{ genre }}
+    Público-Alvo: {{ target_audience }}
     
-    updates["theme"] = theme
-    updates["genre"] = genre
-    updates["target_audience"] = target_audience
+    Inclua entre 5 e 100 capítulos, numerados a partir de 1, cada um abordando um aspecto técnico ou prático do tema, com títulos objetivos e descrições que detalhem o conteúdo analítico a ser explorado.
+    """,
+    "chapter_preamble": """
+    Você é um especialista técnico escrevendo um livro intitulado "{{ title }}" 
+    com o tema "{{ theme }}" no gênero "{{ genre }}" para o público "{{ target_audience }}".
     
-    prompt = f"""
-    Você é um especialista em redação técnica. Baseado no seguinte tema, gênero e público-alvo, sugira um título formal e técnico que reflita um enfoque analítico e informativo:
-    Tema: {theme}
-    Gênero: {genre}
-    Público-Alvo: {target_audience}
-    Responda SOMENTE em formato JSON com a chave "title", sem texto adicional. Exemplo: {{"title": "Fundamentos de Exploração Espacial"}}. Não inclua bloco de código, ou seja ```json```
-    """
+    Escreva um texto técnico e analítico, com linguagem formal e objetiva. Inclua informações técnicas detalhadas, exemplos contextualizados (reais ou hipotéticos), dados relevantes e explicações claras. Evite diálogos narrativos ou descrições literárias excessivas. Estruture o conteúdo com seções claras (ex.: introdução, análise, exemplos, conclusão). O capítulo deve ter pelo menos 3000 palavras. Seja o mais detalhista possível e aborde o tema do capítulo com profundidade e bastante exemplo.
+    """,
+    "chapter": """
+    Escreva o Capítulo {{ chapter_num }}: "{{ chapter.title }}".
+    
+    Descrição do capítulo: {{ chapter.description }}
+    {% if prev_chapter %}
+    
+    Capítulo anterior ({{ chapter_num - 1 }}: {{ prev_chapter.title }}):
+    {{ prev_chapter.description }}
+    {% endif %}
+    """,
+    "summary": """
+    Resuma o capítulo abaixo em no máximo 80 palavras, em um único parágrafo, destacando os conceitos e conclusões principais.
+    
+    {{ content }}
+    """,
+    "review": """
+    Você é um editor revisando o livro:
     
-    logger.info("Gerando título com base no tema...")
-    response = model.generate_content(prompt)
-    logger.debug(f"Resposta bruta do modelo: {response.text}")
-    info = safe_json_parse(response.text, {"title": f"Livro sobre {theme}"})
-    updates["title"] = info.get("title", f"Livro sobre {theme}")
-    logger.info(f"Título gerado: {updates['title']}")
+    {{ book_summary }}
     
-    updates["status"] = "book_info_collected"
-    logger.debug(f"Atualizações de get_book_info: {updates}")
-    return updates
+    Forneça feedback sobre estrutura, fluxo narrativo, consistência com o tema "{{ theme }}" 
+    e apelo ao público-alvo. Sugira melhorias. Revise tecnicamente o livro e verifique se há alguma inconsistência.
+    """,
+}
 
-def create_outline(state: BookState, model) -> Dict[str, Any]:
-    """Cria o sumário do livro baseado nas informações fornecidas."""
-    logger.info("Criando sumário do livro...")
-    
-    prompt = f"""
-    Você é um especialista técnico elaborando um livro técnico para estudo de um determinado tema. 
-    Baseado nas seguintes informações, crie um sumário detalhado e com pelo menos 3 níveis de aprofundamento com foco em aspectos técnicos e práticos:
+prompt_env = Environment(loader=DictLoader(PROMPT_TEMPLATES), autoescape=False, trim_blocks=True, lstrip_blocks=True)
+PLAN_BOOK_PROMPT = prompt_env.get_template("plan_book")
+CHAPTER_PREAMBLE_PROMPT = prompt_env.get_template("chapter_preamble")
+CHAPTER_PROMPT = prompt_env.get_template("chapter")
+SUMMARY_PROMPT = prompt_env.get_template("summary")
+REVIEW_PROMPT = prompt_env.get_template("review")
+# Versão do template de planejamento: ao editá-lo, as respostas do cache semântico deixam de valer
+PLAN_BOOK_PROMPT_HASH = hashlib.blake2b(PROMPT_TEMPLATES["plan_book"].encode(), digest_size=8).hexdigest()
+
+# Tamanho máximo do nome base dos arquivos exportados (antes de sufixos como "_feedback.txt")
+SLUG_MAX_LENGTH = 80
+
+def slugify(title: str) -> str:
+    """Converte o título em um nome de arquivo seguro, somente com caracteres ASCII."""
+    ascii_title = unicodedata.normalize("NFKD", title).encode("ascii", "ignore").decode()
+    return re.sub(r"[^\w-]", "_", ascii_title)[:SLUG_MAX_LENGTH] or "livro"
+
+# Funções para cada etapa do processo
+async def plan_book(state: BookState, model) -> Dict[str, Any]:
+    """Gera o título e o sumário do livro em uma única chamada ao modelo."""
+    logger.info(f"Estado recebido em plan_book: {state}")
+    logger.info("Planejando título e sumário do livro...")
     
-    Tema: {state['theme']}
-    Título sugerido: {state['title']}
-    Gênero: {state['genre']}
-    Público-Alvo: {state['target_audience']}
+    # Garantir valores padrão se não fornecidos
+    theme = state.get("theme", "Um tema genérico")
+    genre = state.get("genre", "Ficção")
+    target_audience = state.get("target_audience", "Adultos")
     
-    Inclua entre 5 e 100 capítulos, cada um abordando um aspecto técnico ou prático do tema, com títulos objetivos e descrições que detalhem o conteúdo analítico a ser explorado.
-    Responda SOMENTE em formato JSON com uma lista de objetos contendo "chapter_number", "chapter_title" e "chapter_description".
-    Exemplo: [{{"chapter_number": 1, "chapter_title": "Princípios de Propulsão Espacial", "chapter_description": "Análise dos sistemas de propulsão usados em missões espaciais"}}]
-    Não inclua bloco de código, ou seja ```json```
-    """
+    prompt = PLAN_BOOK_PROMPT.render(theme=theme, genre=genre, target_audience=target_audience)
     
-    response = model.generate_content(prompt)
-    logger.debug(f"Resposta bruta do modelo: {response.text}")
-    outline_data = safe_json_parse(response.text, [
-        {"chapter_number": 1, "chapter_title": "Introdução", 
-         "chapter_description": f"Exploração inicial do tema {state['theme']}."}
-    ])
+    fallback = BookPlan(
+        title=f"Livro sobre {theme}",
+        outline=[OutlineItem(chapter_number=1, chapter_title="Introdução",
+                             chapter_description=f"Exploração inicial do tema {theme}.")]
+    )
+    # Só o tema varia entre livros do mesmo perfil; gênero e público-alvo separam os namespaces
+    semantic = (f"{PLAN_BOOK_PROMPT_HASH}|{genre}|{target_audience}", theme)
+    plan = await generate_validated(model, prompt, fallback, BookPlan, BOOK_PLAN_SCHEMA, semantic=semantic)
+    outline_data = plan.outline
+    logger.info(f"Título gerado: {plan.title}")
     
     # Garantir pelo menos 5 capítulos
     if len(outline_data) < 5:
         logger.warning("Sumário com menos de 5 capítulos. Adicionando capítulos extras.")
         for i in range(len(outline_data) + 1, 6):
-            outline_data.append({
-                "chapter_number": i,
-                "chapter_title": f"Capítulo {i}",
-                "chapter_description": f"Continuação da exploração de {state['theme']}."
-            })
+            outline_data.append(OutlineItem(
+                chapter_number=i,
+                chapter_title=f"Capítulo {i}",
+                chapter_description=f"Continuação da exploração de {theme}."
+            ))
     
     updates = {
-        "outline": outline_data,
-        "chapters": {item["chapter_number"]: {"title": item["chapter_title"], 
-                                              "description": item["chapter_description"],
-                                              "content": ""} 
-                     for item in outline_data},
-        "current_chapter": 1,
+        "theme": theme,
+        "genre": genre,
+        "target_audience": target_audience,
+        "title": plan.title,
+        "slug": slugify(plan.title),
+        # Ordenado e numerado uma única vez aqui: as demais etapas percorrem a lista em ordem
+        "chapters": [ChapterModel(number=number, title=item.chapter_title, description=item.chapter_description)
+                     for number, item in enumerate(sorted(outline_data, key=lambda item: item.chapter_number), 1)],
         "status": "outline_created"
     }
     logger.info(f"Sumário criado com {len(outline_data)} capítulos.")
     logger.info(f"Capítulos gerados: {updates['chapters']}")
     return updates
 
-def write_chapter(state: BookState, model) -> Dict[str, Any]:
-    """Escreve o conteúdo para o capítulo atual."""
-    current = state["current_chapter"]
-    updates = {}
-    if current > len(state["chapters"]):
-        updates["status"] = "all_chapters_written"
-        logger.info("Todos os capítulos foram escritos.")
-        return updates
-    
-    chapter_info = state["chapters"][current]
-    logger.info(f"Escrevendo Capítulo {current}: {chapter_info['title']}...")
-    
-    prev_content = ""
-    if current > 1 and state["chapters"].get(current-1, {}).get("content"):
-        prev_chapter = state["chapters"][current-1]
-        prev_content = f"""
-        Resumo do capítulo anterior ({current-1}: {prev_chapter['title']}):
-        {prev_chapter['content'][:500]}... (resumido)
-        """
-    
-    prompt = f"""
-    Você é um especialista técnico escrevendo um livro intitulado "{state['title']}" 
-    com o tema "{state['theme']}" no gênero "{state['genre']}" para o público "{state['target_audience']}".
-    
-    Escreva o Capítulo {current}: "{chapter_info['title']}".
-    
-    Descrição do capítulo: {chapter_info['description']}
-    
-    {prev_content}
-    
-    Escreva um texto técnico e analítico, com linguagem formal e objetiva. Inclua informações técnicas detalhadas, exemplos contextualizados (reais ou hipotéticos), dados relevantes e explicações claras. Evite diálogos narrativos ou descrições literárias excessivas. Estruture o conteúdo com seções claras (ex.: introdução, análise, exemplos, conclusão). O capítulo deve ter pelo menos 3000 palavras. Seja o mais detalhista possível e aborde o tema do capítulo com profundidade e bastante exemplo.
-    """
-    
-    response = model.generate_content(prompt)
-    updated_chapters = state["chapters"].copy()
-    updated_chapters[current]["content"] = response.text
-    updates["chapters"] = updated_chapters
-    logger.info(f"Capítulo {current} concluído com sucesso.")
-    
-    updates["current_chapter"] = current + 1
-    updates["status"] = "chapter_written" if updates["current_chapter"] <= len(state["chapters"]) else "all_chapters_written"
+def chapter_draft_path(drafts_dir: str, chapter_num: int) -> Path:
+    """Caminho do rascunho em disco com o texto de um capítulo."""
+    return Path(drafts_dir, f"{chapter_num:03d}.txt")
+
+async def write_all_chapters(state: BookState, model, summary_model) -> Dict[str, Any]:
+    """Escreve todos os capítulos em paralelo, gravando o texto nos rascunhos em disco e os resumos no estado."""
+    chapters = state["chapters"]
+    drafts_dir = f"{state['slug']}_capitulos"
+    await asyncio.to_thread(os.makedirs, drafts_dir, exist_ok=True)
+    logger.info(f"Escrevendo {len(chapters)} capítulos em paralelo (máximo de {MAX_CONCURRENT_CHAPTERS} simultâneos)...")
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHAPTERS)
+    
+    # O preâmbulo é o mesmo para todos os capítulos e é montado uma única vez
+    preamble = CHAPTER_PREAMBLE_PROMPT.render(title=state["title"], theme=state["theme"],
+                                              genre=state["genre"], target_audience=state["target_audience"])
+    
+    async def write(chapter: ChapterModel, prev_chapter: Optional[ChapterModel]) -> str:
+        # O contexto do capítulo anterior vem do sumário, para que os capítulos sejam independentes
+        prompt = preamble + CHAPTER_PROMPT.render(chapter_num=chapter.number, chapter=chapter,
+                                                  prev_chapter=prev_chapter)
+        
+        async with semaphore:
+            logger.info(f"Escrevendo Capítulo {chapter.number}: {chapter.title}...")
+            draft = await asyncio.to_thread(chapter_draft_path(drafts_dir, chapter.number).open, "w", encoding="utf-8")
+            
+            async def append(text: str):
+                await asyncio.to_thread(draft.write, text)
+                await asyncio.to_thread(draft.flush)
+            
+            try:
+                content = await cached_generate(model, prompt, on_chunk=append)
+            finally:
+                await asyncio.to_thread(draft.close)
+        logger.info(f"Capítulo {chapter.number} concluído com sucesso.")
+        
+        async with semaphore:
+            return await cached_generate(summary_model, SUMMARY_PROMPT.render(content=content))
+    
+    summaries = await asyncio.gather(*(write(chapter, chapters[i - 1] if i else None)
+                                       for i, chapter in enumerate(chapters)))
+    updates = {
+        "chapters": [chapter.model_copy(update={"summary": summary})
+                     for chapter, summary in zip(chapters, summaries)],
+        "drafts_dir": drafts_dir,
+        "status": "all_chapters_written"
+    }
+    logger.info("Todos os capítulos foram escritos.")
     return updates
 
-def review_and_edit(state: BookState, model) -> Dict[str, Any]:
-    """Revisa e edita o livro completo."""
-    logger.info("Revisando e editando o livro...")
-    book_summary = f"""
+# Limite de cada resumo no esqueleto do livro (o prompt de resumo pede no máximo 80 palavras)
+MAX_SUMMARY_CHARS = 600
+
+def build_book_skeleton(state: BookState) -> str:
+    """Monta o esqueleto do livro usado na revisão, com os resumos limitados a `MAX_SUMMARY_CHARS`."""
+    header = f"""
     Tema: {state['theme']}
     Título: {state['title']}
     Gênero: {state['genre']}
@@ -209,111 +592,105 @@ def review_and_edit(state: BookState, model) -> Dict[str, Any]:
     
     Sumário:
     """
-    for chapter_num, chapter_data in sorted(state["chapters"].items()):
-        book_summary += f"\nCapítulo {chapter_num}: {chapter_data['title']} - {chapter_data['description'][:100]}..."
-    
-    prompt = f"""
-    Você é um editor revisando o livro:
-    
-    {book_summary}
-    
-    Forneça feedback sobre estrutura, fluxo narrativo, consistência com o tema "{state['theme']}" 
-    e apelo ao público-alvo. Sugira melhorias. Revise tecnicamente o livro e verifique se há alguma inconsistência.
-    """
+    return header + "\n" + "\n".join(
+        f"Capítulo {chapter.number}: {chapter.title} - {chapter.summary[:MAX_SUMMARY_CHARS]}"
+        for chapter in state["chapters"]
+    )
+
+async def review_book(state: BookState, model) -> str:
+    """Revisa o livro completo e retorna o feedback."""
+    logger.info("Revisando e editando o livro...")
+    prompt = REVIEW_PROMPT.render(book_summary=build_book_skeleton(state), theme=state["theme"])
     
-    response = model.generate_content(prompt)
-    updates = {
-        "feedback": response.text,
-        "status": "reviewed"
-    }
+    feedback = await cached_generate(model, prompt)
     logger.info("Revisão concluída. Feedback gerado.")
-    
-    return updates
+    return feedback
 
-def export_feedback(state: BookState) -> Dict[str, Any]:
-    """Exporta o feedback para um arquivo TXT."""
-    logger.info("Exportando feedback para TXT...")
-    feedback_path = f"{state['title'].replace(' ', '_')}_feedback.txt"
-    with open(feedback_path, "w", encoding="utf-8") as f:
-        f.write(state["feedback"])
-    updates = {
-        "feedback_path": feedback_path,
-        "status": "feedback_exported"
-    }
-    logger.info(f"Feedback exportado com sucesso para: {feedback_path}")
-    return updates
+def _write_feedback(slug: str, feedback: str) -> str:
+    """Grava o feedback da revisão em um arquivo TXT e retorna o caminho do arquivo."""
+    feedback_path = f"{slug}_feedback.txt"
+    Path(feedback_path).write_text(feedback, encoding="utf-8")
+    return feedback_path
 
-def export_book(state: BookState) -> Dict[str, Any]:
-    """Exporta o livro apenas para DOCX."""
-    logger.info("Exportando livro para DOCX...")
+def _write_docx(state: BookState) -> str:
+    """Monta o DOCX a partir dos rascunhos dos capítulos e retorna o caminho do arquivo."""
+    # Importado aqui para que o custo de carregar o python-docx só seja pago na exportação
+    from docx import Document
+    
     doc = Document()
     doc.add_heading(state["title"], 0)
     doc.add_paragraph(f"Tema: {state['theme']}")
     doc.add_paragraph(f"Gênero: {state['genre']}")
     doc.add_paragraph(f"Público-alvo: {state['target_audience']}")
     
-    for chapter_num, chapter_data in sorted(state["chapters"].items()):
-        doc.add_heading(f"Capítulo {chapter_num}: {chapter_data['title']}", 1)
-        doc.add_paragraph(chapter_data["content"])
+    for chapter in state["chapters"]:
+        doc.add_heading(f"Capítulo {chapter.number}: {chapter.title}", 1)
+        # Lê um capítulo por vez do disco
+        doc.add_paragraph(chapter_draft_path(state["drafts_dir"], chapter.number).read_text(encoding="utf-8"))
     
-    doc_path = f"{state['title'].replace(' ', '_')}.docx"
+    doc_path = f"{state['slug']}.docx"
     doc.save(doc_path)
+    return doc_path
+
+async def finalize(state: BookState, model) -> Dict[str, Any]:
+    """Revisa o livro enquanto exporta o DOCX; em seguida grava o feedback em TXT."""
+    logger.info("Exportando livro para DOCX durante a revisão...")
+    feedback, doc_path = await asyncio.gather(
+        review_book(state, model),
+        asyncio.to_thread(_write_docx, state)
+    )
+    feedback_path = await asyncio.to_thread(_write_feedback, state["slug"], feedback)
     updates = {
+        "feedback": feedback,
+        "feedback_path": feedback_path,
         "export_path": doc_path,
         "status": "exported"
     }
+    logger.info(f"Feedback exportado com sucesso para: {feedback_path}")
     logger.info(f"Livro exportado com sucesso para: {doc_path}")
     return updates
 
+# Próximo nó para cada status do livro
+_ROUTER = {
+    "start": "plan_book",
+    "outline_created": "write_all_chapters",
+    "all_chapters_written": "finalize",
+    "exported": END
+}
+
 def router(state: BookState) -> str:
     """Decide o próximo estado."""
-    status_map = {
-        "start": "get_book_info",
-        "book_info_collected": "create_outline",
-        "outline_created": "write_chapter",
-        "chapter_written": "write_chapter",
-        "all_chapters_written": "review_and_edit",
-        "reviewed": "export_feedback", # Adicionado o novo estado
-        "feedback_exported": "export_book", # Adicionado o novo estado
-        "exported": END
-    }
-    next_state = status_map.get(state["status"], END)
+    next_state = _ROUTER.get(state["status"], END)
     logger.debug(f"Transição de estado: {state['status']} -> {next_state}")
     return next_state
 
-def create_book_agent(model):
+def create_book_agent(model, summary_model):
     """Cria o agente de geração de livros."""
     logger.info("Criando agente de geração de livros...")
     workflow = StateGraph(BookState)
     
     # Adicionar nós com passagem de modelo
-    workflow.add_node("get_book_info", lambda state: get_book_info(state, model))
-    workflow.add_node("create_outline", lambda state: create_outline(state, model))
-    workflow.add_node("write_chapter", lambda state: write_chapter(state, model))
-    workflow.add_node("review_and_edit", lambda state: review_and_edit(state, model))
-    workflow.add_node("export_feedback", export_feedback) # Adicionado o novo nó
-    workflow.add_node("export_book", export_book)
+    workflow.add_node("plan_book", partial(plan_book, model=model))
+    workflow.add_node("write_all_chapters", partial(write_all_chapters, model=model, summary_model=summary_model))
+    workflow.add_node("finalize", partial(finalize, model=model))
     
     # Definir ponto de entrada
-    workflow.set_entry_point("get_book_info")
+    workflow.set_entry_point("plan_book")
     
     # Adicionar arestas condicionais
-    workflow.add_conditional_edges("get_book_info", router)
-    workflow.add_conditional_edges("create_outline", router)
-    workflow.add_conditional_edges("write_chapter", router)
-    workflow.add_conditional_edges("review_and_edit", router)
-    workflow.add_conditional_edges("export_feedback", router) # Adicionado o novo nó
-    workflow.add_conditional_edges("export_book", router)
+    workflow.add_conditional_edges("plan_book", router)
+    workflow.add_conditional_edges("write_all_chapters", router)
+    workflow.add_conditional_edges("finalize", router)
     
     # Configurar o checkpointer na compilação
     memory = MemorySaver()
     return workflow.compile(checkpointer=memory)
 
-def main(custom_theme: str = "", custom_genre: str = "", custom_audience: str = ""):
+async def main(custom_theme: str = "", custom_genre: str = "", custom_audience: str = ""):
     """Executa o agente de geração de livros."""
     logger.info("Iniciando processo de geração de livro...")
-    model = init_vertex_ai(os.getenv("PROJECT_ID"))
-    book_agent = create_book_agent(model)
+    model, summary_model = await init_vertex_ai(os.getenv("PROJECT_ID"))
+    book_agent = create_book_agent(model, summary_model)
     
     initial_state = BookState(status="start")
     if custom_theme:
@@ -323,30 +700,32 @@ def main(custom_theme: str = "", custom_genre: str = "", custom_audience: str =
     if custom_audience:
         initial_state["target_audience"] = custom_audience
     
-    # Configuração para usar o checkpointer com thread_id
-    config = {"configurable": {"thread_id": "1"}}
+    # Um thread_id por execução, para que livros gerados no mesmo processo não compartilhem checkpoints
+    config = {"configurable": {"thread_id": uuid.uuid4().hex}}
     
-    for output in book_agent.stream(initial_state, config=config):
+    async for output in book_agent.astream(initial_state, config=config):
         # Capturar o estado da chave correspondente ao nó atual
-        node_name = list(output.keys())[0] if output else "unknown"
-        stage = output.get(node_name, {}).get("status", "desconhecido")
-        print(f"Concluído: {stage}")
-        if stage == "book_info_collected":
-            print(f"Tema: {output[node_name]['theme']}")
-            print(f"Título gerado: {output[node_name]['title']}")
-            print(f"Gênero: {output[node_name]['genre']}")
-            print(f"Público-alvo: {output[node_name]['target_audience']}")
-        elif stage == "outline_created":
-            print(f"Sumário criado com {len(output[node_name]['outline'])} capítulos")
-        elif stage == "chapter_written":
-            print(f"Capítulo {output[node_name]['current_chapter']-1} concluído")
-        elif stage == "feedback_exported":
-            print(f"Feedback exportado para: {output[node_name]['feedback_path']}")
+        node_name = next(iter(output), "unknown")
+        node_state = output.get(node_name, {})
+        stage = node_state.get("status", "desconhecido")
+        # Uma única mensagem de log por etapa
+        if stage == "outline_created":
+            logger.info(f"Concluído: {stage} | Tema: {node_state['theme']} | Título gerado: {node_state['title']} | "
+                        f"Gênero: {node_state['genre']} | Público-alvo: {node_state['target_audience']} | "
+                        f"Sumário criado com {len(node_state['chapters'])} capítulos")
+        elif stage == "all_chapters_written":
+            logger.info(f"Concluído: {stage} | Capítulos salvos em: {node_state['drafts_dir']}")
         elif stage == "exported":
-            print(f"Livro exportado para: {output[node_name]['export_path']}")
+            logger.info(f"Concluído: {stage} | Feedback exportado para: {node_state['feedback_path']} | "
+                        f"Livro exportado para: {node_state['export_path']}")
+        else:
+            logger.info(f"Concluído: {stage}")
     
     # Recuperar o estado final usando o mesmo config
     final_state = book_agent.checkpointer.get(config)
+    if LLM_CACHE_ENABLED:
+        logger.info(f"Cache de respostas: {cache_stats['hits']} acertos, "
+                    f"{cache_stats['semantic_hits']} acertos semânticos, {cache_stats['misses']} falhas")
     logger.info("Processo de geração de livro concluído!")
     return final_state
 
@@ -357,8 +736,12 @@ if __name__ == "__main__":
     parser.add_argument("--theme", default="", help="Tema do livro (opcional)")
     parser.add_argument("--genre", default="", help="Gênero do livro (opcional)")
     parser.add_argument("--audience", default="", help="Público-alvo do livro (opcional)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Gera todas as respostas novamente, sem ler nem gravar o cache (opcional)")
     
     args = parser.parse_args()
+    if args.no_cache:
+        LLM_CACHE_ENABLED = False
     
-    result = main(args.theme, args.genre, args.audience)
+    result = asyncio.run(main(args.theme, args.genre, args.audience))
     print("Processo de geração de livro concluído!")